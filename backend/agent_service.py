@@ -1,17 +1,31 @@
 # backend/agent_service.py
 import os
+import re
+import asyncio
+import functools
 import logging
 import base64
+import hashlib
+import json
+import random
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from typing import TypedDict, List
+from typing import TypedDict, List, Sequence
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from langgraph.graph import StateGraph, END
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import HumanMessage, AIMessage
-import time
-from pydantic import BaseModel, validator
+try:
+    from langchain_google_genai import create_context_cache
+except ImportError:
+    create_context_cache = None
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from pydantic import BaseModel, field_validator
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -22,20 +36,56 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Configure Rate Limiter
-limiter = Limiter(key_func=get_remote_address)
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Service configuration, read from the environment once at startup."""
+    gemini_key: str
+    max_image_bytes: int
+    valid_frameworks: frozenset[str]
+    rate_limit_storage_uri: str
+
+MAX_IMAGE_SIZE_MB = 10
 
 # Validate environment variables at startup
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
+_gemini_key = os.getenv("GEMINI_API_KEY")
+if not _gemini_key:
     logger.error("GEMINI_API_KEY not found in environment variables")
     raise ValueError("GEMINI_API_KEY must be set in .env file. Please create a .env file with GEMINI_API_KEY=your_key")
 
+SETTINGS = Settings(
+    gemini_key=_gemini_key,
+    max_image_bytes=MAX_IMAGE_SIZE_MB * 1024 * 1024,
+    valid_frameworks=frozenset({'html', 'react', 'vue', 'nextjs'}),
+    rate_limit_storage_uri=os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+)
+
 logger.info("✓ Environment variables validated successfully")
 
+# Configure Rate Limiter
+# The default in-memory store is per process; multiple workers need a shared store (e.g. redis://).
+limiter = Limiter(key_func=get_remote_address, storage_uri=SETTINGS.rate_limit_storage_uri)
+
 # --- Pydantic Validation Model ---
-MAX_IMAGE_SIZE_MB = 10
-MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
+
+_IMAGE_MIME_TYPES = {
+    b'\xff\xd8\xff': "image/jpeg",
+    b'\x89PNG\r\n\x1a\n': "image/png",
+    b'GIF87a': "image/gif",
+    b'GIF89a': "image/gif",
+}
+_IMAGE_MAGIC = tuple(_IMAGE_MIME_TYPES)
+
+def _decode_image_header(base64_image: str) -> bytes:
+    """Decodes just enough of the payload to cover the magic bytes."""
+    return base64.b64decode(base64_image[:24], validate=True)
+
+def _detect_image_mime(base64_image: str) -> str | None:
+    """Sniffs the image MIME type from the magic bytes of the first decoded chunk."""
+    header = _decode_image_header(base64_image)
+    for magic, mime in _IMAGE_MIME_TYPES.items():
+        if header.startswith(magic):
+            return mime
+    return None
 
 class Message(BaseModel):
     role: str
@@ -47,7 +97,8 @@ class GenerateRequest(BaseModel):
     framework: str = "react"
     history: List[Message] = []
 
-    @validator('prompt')
+    @field_validator('prompt')
+    @classmethod
     def validate_prompt(cls, v):
         if not v or not v.strip():
             raise ValueError("Prompt cannot be empty")
@@ -55,37 +106,237 @@ class GenerateRequest(BaseModel):
             raise ValueError("Prompt too long (max 5000 characters)")
         return v.strip()
 
-    @validator('base64Image')
+    @field_validator('base64Image')
+    @classmethod
     def validate_base64_image(cls, v):
         if v is None:
             return v
         try:
-            image_data = base64.b64decode(v)
-            image_size = len(image_data)
-            if image_size > MAX_IMAGE_SIZE_BYTES:
+            # Size is derived from the encoded length; only the header is decoded for sniffing.
+            image_size = (len(v) * 3) // 4 - v[-2:].count("=")
+            if image_size > SETTINGS.max_image_bytes:
                 raise ValueError(
                     f"Image too large: {image_size / 1024 / 1024:.1f}MB. "
                     f"Maximum allowed: {MAX_IMAGE_SIZE_MB}MB"
                 )
-            if not (image_data.startswith(b'\xff\xd8\xff') or  # JPEG
-                    image_data.startswith(b'\x89PNG') or      # PNG
-                    image_data.startswith(b'GIF')):           # GIF
+            if not _decode_image_header(v).startswith(_IMAGE_MAGIC):
                 raise ValueError("Invalid image format. Only JPEG, PNG, and GIF are supported")
             return v
         except base64.binascii.Error:
             raise ValueError("Invalid base64 encoding")
 
-    @validator('framework')
+    @property
+    def image_mime(self) -> str | None:
+        return _detect_image_mime(self.base64Image) if self.base64Image else None
+
+    @field_validator('framework')
+    @classmethod
     def validate_framework(cls, v):
-        valid_frameworks = ['html', 'react', 'vue', 'nextjs']
-        if v not in valid_frameworks:
-            raise ValueError(f"Invalid framework. Must be one of: {', '.join(valid_frameworks)}")
+        if v not in SETTINGS.valid_frameworks:
+            raise ValueError(f"Invalid framework. Must be one of: {', '.join(sorted(SETTINGS.valid_frameworks))}")
         return v
 
+# --- LLM Clients ---
+# Built once at import so the underlying transport and its connections are reused across requests.
+_LLM_CLASSIFY = ChatGoogleGenerativeAI(model="gemini-2.5-flash", google_api_key=SETTINGS.gemini_key, temperature=0.0)
+_LLM_CHAT = ChatGoogleGenerativeAI(model="gemini-2.5-flash", google_api_key=SETTINGS.gemini_key, temperature=0.7)
+_LLM_CODE = ChatGoogleGenerativeAI(
+    model="gemini-2.5-flash",
+    google_api_key=SETTINGS.gemini_key,
+    temperature=0.2,
+    convert_system_message_to_human=True
+)
+
+# Prompts that obviously ask for UI/code, or are nothing but small talk, skip the classifier round-trip entirely.
+_CODE_INTENT_RE = re.compile(r"\b(build|create|generate|make|component|page|ui|button|form|code|react|vue|html)\b", re.I)
+_CHAT_INTENT_RE = re.compile(r"^\s*(hi|hello|hey|thanks|thank you)[\s!.]*$", re.I)
+
+@functools.lru_cache(maxsize=4096)
+def _heuristic_intent(prompt: str, has_image: bool) -> str | None:
+    """Returns the intent when it is obvious from the prompt, or None if the AI classifier is needed."""
+    if has_image or _CODE_INTENT_RE.search(prompt):
+        return "code_generation"
+    if _CHAT_INTENT_RE.match(prompt):
+        return "chat"
+    return None
+
+# --- System Prompts ---
+# Built once per framework so the prompt prefix is byte-identical across requests.
+_FRAMEWORK_INSTRUCTIONS = {
+    'react': "Generate a React JSX component. Use `className` for CSS classes. Use JSX comments {/* like this */}. Inline styles MUST be objects `style={{ key: 'value' }}`.",
+    'nextjs': "Generate a Next.js React JSX component. Use `className` for CSS classes. Use JSX comments {/* like this */}. Inline styles MUST be objects `style={{ key: 'value' }}`.",
+    'vue': "Generate a Vue 3 Single File Component. Use HTML comments <!-- ... -->.",
+    'html': "Generate plain HTML. Use `class` for CSS classes. Use HTML comments <!-- ... -->. Inline styles MUST be strings `style=\"key: value;\"`."
+}
+
+def _build_system_instruction(framework: str, selected_framework_details: str) -> str:
+    return f"""
+    You are an expert code generation AI specialized in creating production-ready, beautiful, and functional components. Your mission is to generate high-quality code that works perfectly and looks amazing.
+
+    CRITICAL REQUIREMENTS:
+    - Framework: **{framework.upper()}**
+    - Generate ONLY the component code, no explanations or markdown
+    - Code must be immediately runnable and functional
+    - Focus on modern, clean, and professional design
+    - Use best practices for the selected framework
+
+    FRAMEWORK-SPECIFIC RULES:
+    {selected_framework_details}
+
+    QUALITY STANDARDS:
+    - Write clean, readable, and well-structured code
+    - Use modern CSS techniques and responsive design
+    - Implement proper accessibility features
+    - Ensure the component is visually appealing
+    - Use semantic HTML and proper component structure
+    - Add appropriate hover states and interactions
+    - Make it mobile-responsive
+
+    OUTPUT FORMAT:
+    - Return ONLY the component code
+    - No markdown code blocks (```)
+    - No explanations or comments outside the code
+    - No wrapper tags like <html> or <body>
+    - Self-contained component that works immediately
+
+    Remember: You are creating production-quality code that developers will use in real projects. Make it exceptional.
+    """
+
+_SYSTEM_INSTRUCTIONS = {
+    framework: _build_system_instruction(framework, details)
+    for framework, details in _FRAMEWORK_INSTRUCTIONS.items()
+}
+
+# --- Context Caching ---
+# Each framework's system prompt is uploaded once as Gemini cached content and
+# referenced by handle; frameworks whose cache could not be created use the uncached path.
+_SYSTEM_CACHE_TTL_SECONDS = 60 * 60
+_LLM_CODE_CACHED: dict[str, ChatGoogleGenerativeAI] = {}
+
+# Gemini rejects cached content below its minimum token count; such prompts are never retried.
+_CACHE_TOO_SMALL_RE = re.compile(r"too small|min_total_token_count", re.I)
+
+def _create_system_caches(frameworks: set[str]):
+    """Creates (or re-creates) the cached system prompt for each framework, dropping those Gemini rejects as too small."""
+    for framework in list(frameworks):
+        try:
+            handle = create_context_cache(
+                _LLM_CODE,
+                messages=[SystemMessage(content=_SYSTEM_INSTRUCTIONS[framework])],
+                ttl=f"{_SYSTEM_CACHE_TTL_SECONDS}s"
+            )
+        except Exception as e:
+            _LLM_CODE_CACHED.pop(framework, None)
+            if _CACHE_TOO_SMALL_RE.search(str(e)):
+                logger.info(f"System prompt for {framework} is below the context cache minimum, using uncached prompt")
+                frameworks.discard(framework)
+            else:
+                logger.warning(f"Context cache unavailable for {framework}, using uncached prompt: {e}")
+            continue
+        _LLM_CODE_CACHED[framework] = ChatGoogleGenerativeAI(
+            model="gemini-2.5-flash",
+            google_api_key=SETTINGS.gemini_key,
+            temperature=0.2,
+            cached_content=handle
+        )
+        logger.info(f"✓ System prompt cached for {framework}")
+
+async def _refresh_system_caches():
+    """Keeps the context caches alive by re-creating them before the TTL runs out."""
+    if create_context_cache is None:
+        logger.info("Context caching not supported by the installed langchain-google-genai, using uncached prompts")
+        return
+    frameworks = set(_SYSTEM_INSTRUCTIONS)
+    while frameworks:
+        await asyncio.to_thread(_create_system_caches, frameworks)
+        if frameworks:
+            await asyncio.sleep(_SYSTEM_CACHE_TTL_SECONDS * 0.8)
+
+# --- Response Cache ---
+# L1: exact-match LRU of generated code keyed by framework, prompt, image and history.
+_L1_MAX_ENTRIES = 1000
+_L1: OrderedDict[str, str] = OrderedDict()
+
+# L2 (opt-in, SEMANTIC_CACHE=1): embedding-similarity lookup for text-only prompts.
+# Requires sentence-transformers; vectors are normalized so cosine similarity is a dot product.
+_SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE") == "1"
+_L2_THRESHOLD = 0.92
+_L2_MAX_ENTRIES = 1000
+# Per framework: a preallocated ring buffer of embeddings, the code stored in each slot, and the next slot to write.
+_L2_VECTORS: dict[str, "np.ndarray"] = {}
+_L2_CODES: dict[str, list[str]] = {}
+_L2_NEXT_SLOT: dict[str, int] = {}
+# Strong references to background L2 inserts so they are not garbage-collected mid-flight.
+_L2_PENDING: set[asyncio.Task] = set()
+
+if _SEMANTIC_CACHE_ENABLED:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    _EMBEDDER = SentenceTransformer("all-MiniLM-L6-v2")
+    logger.info("✓ Semantic cache enabled")
+
+def _image_digest(base64_image: str) -> str:
+    """Hashes the full image payload; run in a worker thread since hashlib releases the GIL on large inputs."""
+    return hashlib.sha256(base64_image.encode()).hexdigest()
+
+def _cache_key(framework: str, prompt: str, image_sha: str, history: Sequence[dict]) -> str:
+    history_sha = hashlib.blake2b(json.dumps(history).encode()).hexdigest() if history else ""
+    return hashlib.blake2b(f"{framework}|{prompt}|{image_sha}|{history_sha}".encode()).hexdigest()
+
+def _l1_get(key: str) -> str | None:
+    code = _L1.get(key)
+    if code is not None:
+        _L1.move_to_end(key)
+    return code
+
+def _l1_put(key: str, code: str):
+    _L1[key] = code
+    _L1.move_to_end(key)
+    if len(_L1) > _L1_MAX_ENTRIES:
+        _L1.popitem(last=False)
+
+def _embed(prompt: str):
+    return _EMBEDDER.encode(prompt, normalize_embeddings=True)
+
+def _l2_best_match(vectors, count: int, prompt: str):
+    query = _embed(prompt)
+    return int((vectors[:count] @ query).argmax()), query
+
+async def _l2_get(framework: str, prompt: str) -> str | None:
+    codes = _L2_CODES.get(framework)
+    if not codes:
+        return None
+    vectors = _L2_VECTORS[framework]
+    best, query = await asyncio.to_thread(_l2_best_match, vectors, len(codes), prompt)
+    # Re-score the winning slot here, in case an insert overwrote it while the thread ran.
+    if float(vectors[best] @ query) < _L2_THRESHOLD:
+        return None
+    return codes[best]
+
+async def _l2_put(framework: str, prompt: str, code: str):
+    vector = await asyncio.to_thread(_embed, prompt)
+    if framework not in _L2_VECTORS:
+        _L2_VECTORS[framework] = np.empty((_L2_MAX_ENTRIES, vector.shape[0]), dtype=vector.dtype)
+        _L2_CODES[framework] = []
+        _L2_NEXT_SLOT[framework] = 0
+    slot = _L2_NEXT_SLOT[framework]
+    codes = _L2_CODES[framework]
+    _L2_VECTORS[framework][slot] = vector
+    if slot < len(codes):
+        codes[slot] = code
+    else:
+        codes.append(code)
+    _L2_NEXT_SLOT[framework] = (slot + 1) % _L2_MAX_ENTRIES
+
 # --- 1. Define the State ---
-class GraphState(TypedDict):
+# Image payloads stay out of the graph state; nodes look them up by request id.
+_REQ_BLOBS: dict[str, str] = {}
+
+class GraphState(TypedDict, total=False):
     prompt: str
-    base64Image: str | None
+    request_id: str
+    has_image: bool
+    image_mime: str | None
     framework: str
     system_instruction: str
     model_parts: List
@@ -94,15 +345,29 @@ class GraphState(TypedDict):
     retry_count: int
     intent: str
     chat_response: str
-    history: List[dict]
+    history_messages: List
 
 # --- 2. Define the Node Functions ---
 
-def classify_intent_node(state: GraphState):
-    """Classifies intent using an AI classifier (chat vs code_generation)."""
+def _to_langchain_messages(history: List[Message]) -> List:
+    """Translates the request history into LangChain messages, once per request."""
+    messages: List = []
+    for m in history:
+        if m.role == "user":
+            messages.append(HumanMessage(content=m.content))
+        elif m.role == "assistant":
+            messages.append(AIMessage(content=m.content))
+    return messages
+
+async def classify_intent_node(state: GraphState):
+    """Classifies intent (chat vs code_generation), falling back to the AI classifier only for ambiguous prompts."""
+    intent = _heuristic_intent(state["prompt"], state["has_image"])
+    if intent:
+        state["intent"] = intent
+        logger.info(f"✓ Intent classified as: {state['intent']} (heuristic)")
+        return state
     logger.info("Classifying intent (AI-driven)...")
     try:
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", google_api_key=GEMINI_API_KEY, temperature=0.0)
         classification_prompt = (
             "You are an intent classifier for an AI coding assistant. "
             "Decide whether the user's latest request should be handled as 'code_generation' or 'chat'.\n"
@@ -110,9 +375,9 @@ def classify_intent_node(state: GraphState):
             "- Choose code_generation if the user asks to create, modify, design, implement, or generate code, or if an image is provided for UI to code.\n"
             "- Otherwise choose chat.\n\n"
             f"User prompt: {state['prompt']}\n"
-            f"Image provided: {bool(state.get('base64Image'))}"
+            f"Image provided: {state['has_image']}"
         )
-        result = llm.invoke(classification_prompt)
+        result = await _LLM_CLASSIFY.ainvoke(classification_prompt)
         raw = (getattr(result, "content", "") or "").strip().lower()
         intent = "code_generation" if "code_generation" in raw else ("chat" if "chat" in raw else "chat")
         state["intent"] = intent
@@ -122,57 +387,40 @@ def classify_intent_node(state: GraphState):
     logger.info(f"✓ Intent classified as: {state['intent']}")
     return state
 
-def chat_node(state: GraphState):
+async def chat_node(state: GraphState):
     """Generates a conversational response to the user's prompt, with history context."""
     logger.info("Generating chat response...")
-    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", google_api_key=GEMINI_API_KEY, temperature=0.7)
-    messages: List = []
-    for m in state.get("history", []):
-        role = m.get("role")
-        content = m.get("content", "")
-        if role == "user":
-            messages.append(HumanMessage(content=content))
-        elif role == "assistant":
-            messages.append(AIMessage(content=content))
-    messages.append(HumanMessage(content=state['prompt']))
-    response_stream = llm.stream(messages)
+    messages = [*state.get("history_messages", []), HumanMessage(content=state['prompt'])]
+    response_stream = _LLM_CHAT.astream(messages)
     state["chat_response"] = response_stream
     return state
 
 def prepare_code_prompt_node(state: GraphState):
     """Prepares the input for the Gemini model for code generation."""
     logger.info(f"Preparing code prompt for framework: {state['framework']}")
-    parts = [{"type": "text", "text": state["prompt"]}]
-    if state["base64Image"]:
-        parts.append({
-            "type": "image_url",
-            "image_url": {"url": f"data:image/png;base64,{state['base64Image']}"}
-        })
-    state["model_parts"] = parts
+    # The image part is attached in generate_code_node so the blob never enters the graph state.
+    state["model_parts"] = [{"type": "text", "text": state["prompt"]}]
     return state
 
-def generate_code_node(state: GraphState):
+async def generate_code_node(state: GraphState):
     """Generates code by calling the Gemini API, with conversation history as context."""
     logger.info(f"Generating code... (attempt {state.get('retry_count', 0) + 1})")
     try:
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            google_api_key=GEMINI_API_KEY,
-            temperature=0.2,
-            convert_system_message_to_human=True
-        )
-        history_messages: List = []
-        for m in state.get("history", []):
-            role = m.get("role")
-            content = m.get("content", "")
-            if role == "user":
-                history_messages.append(HumanMessage(content=content))
-            elif role == "assistant":
-                history_messages.append(AIMessage(content=content))
-        message = HumanMessage(content=state["model_parts"])
-        system_message = state["system_instruction"]
-        payload = [system_message, *history_messages, message]
-        response_stream = llm.stream(payload)
+        history_messages = state.get("history_messages", [])
+        parts = state["model_parts"]
+        if state["has_image"]:
+            parts = [*parts, {
+                "type": "image_url",
+                "image_url": {"url": f"data:{state['image_mime']};base64,{_REQ_BLOBS[state['request_id']]}"}
+            }]
+        message = HumanMessage(content=parts)
+        cached_llm = _LLM_CODE_CACHED.get(state["framework"])
+        if cached_llm:
+            response_stream = cached_llm.astream([*history_messages, message])
+        else:
+            system_message = state["system_instruction"]
+            payload = [system_message, *history_messages, message]
+            response_stream = _LLM_CODE.astream(payload)
         state["generated_code"] = response_stream
         state["error_message"] = None
         logger.info("✓ Code generation successful")
@@ -181,25 +429,27 @@ def generate_code_node(state: GraphState):
         state["error_message"] = str(e)
     return state
 
-def handle_error_node(state: GraphState):
-    """Handles errors and decides whether to retry with exponential backoff."""
-    logger.warning("Handling error...")
-    error = state.get("error_message", "")
-    retries = state.get("retry_count", 0)
-    
-    is_retryable = ("503" in error or "overloaded" in error or 
-                    "rate limit" in error.lower() or "timeout" in error.lower())
-    
-    if is_retryable and retries < 3:
-        delay = 2 ** retries
-        logger.info(f"⏳ Model overloaded, retrying in {delay}s... ({retries + 1}/3)")
-        time.sleep(delay)
-        state["retry_count"] = retries + 1
-        return "generate_code"
-    else:
+_MAX_RETRIES = 3
+_RETRYABLE_RE = re.compile(r"503|overloaded|rate limit|timeout", re.I)
+
+def route_after_generation(state: GraphState):
+    """Ends the run on success or unrecoverable errors; only retryable errors go through handle_error."""
+    error = state.get("error_message")
+    if not error:
+        return END
+    if not _RETRYABLE_RE.search(error) or state.get("retry_count", 0) >= _MAX_RETRIES:
         logger.error(f"✗ Unrecoverable error or max retries reached: {error}")
-        state["generated_code"] = f"An error occurred: {error}"
         return END
+    return "handle_error"
+
+async def handle_error_node(state: GraphState):
+    """Waits out a retryable error with exponential backoff before generation is retried."""
+    retries = state.get("retry_count", 0)
+    delay = (2 ** retries) + random.random()
+    logger.info(f"⏳ Model overloaded, retrying in {delay:.1f}s... ({retries + 1}/{_MAX_RETRIES})")
+    await asyncio.sleep(delay)
+    state["retry_count"] = retries + 1
+    return state
 
 # --- 3. Build the Graph with Routing Logic ---
 workflow = StateGraph(GraphState)
@@ -214,13 +464,19 @@ workflow.set_entry_point("classify_intent")
 workflow.add_conditional_edges("classify_intent", lambda state: state["intent"], { "code_generation": "prepare_code_prompt", "chat": "chat" })
 workflow.add_edge("chat", END)
 workflow.add_edge("prepare_code_prompt", "generate_code")
-workflow.add_conditional_edges("generate_code", lambda state: "handle_error" if state.get("error_message") else END)
+workflow.add_conditional_edges("generate_code", route_after_generation)
 workflow.add_edge("handle_error", "generate_code")
 
 app_graph = workflow.compile()
 
 # --- 4. Create FastAPI App to Serve the Agent ---
-api = FastAPI(title="CodeCanvas AI API", description="AI-powered code generation service", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    refresh_task = asyncio.create_task(_refresh_system_caches())
+    yield
+    refresh_task.cancel()
+
+api = FastAPI(title="CodeCanvas AI API", description="AI-powered code generation service", version="1.0.0", lifespan=lifespan)
 
 api.state.limiter = limiter
 api.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -233,9 +489,111 @@ api.add_middleware(
 )
 logger.info("✓ CORS middleware configured")
 
+# The health payload never changes at runtime, so it is serialized once.
+_HEALTH_BYTES = json.dumps({"status": "healthy", "version": "1.0.0", "api_key_configured": bool(SETTINGS.gemini_key)}).encode()
+
 @api.get("/health")
 async def health_check():
-    return {"status": "healthy", "version": "1.0.0", "api_key_configured": bool(GEMINI_API_KEY)}
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
+
+# Tokens are coalesced before crossing the ASGI boundary; the first batch still goes out immediately.
+_STREAM_FLUSH_BYTES = 4096
+_STREAM_FLUSH_SECONDS = 0.02
+
+async def _coalesce_tokens(token_stream, sink: List[str] | None = None):
+    """Re-yields an LLM token stream as UTF-8 bytes in size/time-bounded batches."""
+    tokens = aiter(token_stream)
+    buf = bytearray()
+    last_flush = time.monotonic()
+    # The pending read is awaited with asyncio.wait rather than wait_for: a timeout must flush
+    # the buffer without cancelling the read, which would tear down the upstream stream.
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(anext(tokens))
+            timeout = max(0.0, last_flush + _STREAM_FLUSH_SECONDS - time.monotonic()) if buf else None
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                yield bytes(buf)
+                buf.clear()
+                last_flush = time.monotonic()
+                continue
+            try:
+                token = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+            if sink is not None:
+                sink.append(token.content)
+            buf.extend(token.content.encode())
+            now = time.monotonic()
+            if len(buf) >= _STREAM_FLUSH_BYTES or now - last_flush >= _STREAM_FLUSH_SECONDS:
+                yield bytes(buf)
+                buf.clear()
+                last_flush = now
+        if buf:
+            yield bytes(buf)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+# --- Request Coalescing ---
+# Identical concurrent requests share one upstream call. The upstream stream runs in its own task
+# that records every chunk; each request, including the first, is just a subscriber, so any one
+# client disconnecting does not cut the others off.
+class _Flight:
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.subscribers: List[asyncio.Queue] = []
+        self.done = False
+        self.task: asyncio.Task | None = None
+
+_INFLIGHT: dict[str, _Flight] = {}
+
+async def _run_flight(key: str, flight: _Flight, stream):
+    """Drives the upstream stream, publishing each chunk to the flight's subscribers."""
+    try:
+        async for chunk in stream:
+            flight.chunks.append(chunk)
+            for queue in flight.subscribers:
+                queue.put_nowait(chunk)
+    finally:
+        if _INFLIGHT.get(key) is flight:
+            del _INFLIGHT[key]
+        flight.done = True
+        for queue in flight.subscribers:
+            queue.put_nowait(None)
+
+def _start_flight(key: str, stream) -> _Flight:
+    flight = _INFLIGHT[key] = _Flight()
+    flight.task = asyncio.create_task(_run_flight(key, flight, stream))
+    return flight
+
+def _join_flight(key: str, flight: _Flight):
+    """Subscribes to a running flight now and returns the response body that replays and follows it."""
+    queue: asyncio.Queue = asyncio.Queue()
+    # Snapshot and subscribe without awaiting in between so no chunk is missed or duplicated.
+    replay = list(flight.chunks)
+    flight.subscribers.append(queue)
+
+    async def follow():
+        try:
+            for chunk in replay:
+                yield chunk
+            while (chunk := await queue.get()) is not None:
+                yield chunk
+        finally:
+            if queue in flight.subscribers:
+                flight.subscribers.remove(queue)
+            if not flight.subscribers and not flight.done:
+                # Nobody is listening any more; stop the upstream call.
+                if _INFLIGHT.get(key) is flight:
+                    del _INFLIGHT[key]
+                flight.task.cancel()
+
+    return follow()
 
 @api.post("/api/generate")
 @limiter.limit("5/minute")
@@ -244,82 +602,110 @@ async def generate(request: Request, request_data: GenerateRequest):
     
     framework = request_data.framework
     
-    # --- THIS IS THE FINAL, MORE FORCEFUL PROMPT LOGIC ---
-    framework_instructions = {
-        'react': "Generate a React JSX component. Use `className` for CSS classes. Use JSX comments {/* like this */}. Inline styles MUST be objects `style={{ key: 'value' }}`.",
-        'nextjs': "Generate a Next.js React JSX component. Use `className` for CSS classes. Use JSX comments {/* like this */}. Inline styles MUST be objects `style={{ key: 'value' }}`.",
-        'vue': "Generate a Vue 3 Single File Component. Use HTML comments <!-- ... -->.",
-        'html': "Generate plain HTML. Use `class` for CSS classes. Use HTML comments <!-- ... -->. Inline styles MUST be strings `style=\"key: value;\"`."
-    }
+    system_instruction = _SYSTEM_INSTRUCTIONS.get(framework, _SYSTEM_INSTRUCTIONS['html'])
     
-    selected_framework_details = framework_instructions.get(framework, framework_instructions['html'])
-
-    system_instruction = f"""
-    You are an expert code generation AI specialized in creating production-ready, beautiful, and functional components. Your mission is to generate high-quality code that works perfectly and looks amazing.
-
-    CRITICAL REQUIREMENTS:
-    - Framework: **{framework.upper()}**
-    - Generate ONLY the component code, no explanations or markdown
-    - Code must be immediately runnable and functional
-    - Focus on modern, clean, and professional design
-    - Use best practices for the selected framework
-
-    FRAMEWORK-SPECIFIC RULES:
-    {selected_framework_details}
-
-    QUALITY STANDARDS:
-    - Write clean, readable, and well-structured code
-    - Use modern CSS techniques and responsive design
-    - Implement proper accessibility features
-    - Ensure the component is visually appealing
-    - Use semantic HTML and proper component structure
-    - Add appropriate hover states and interactions
-    - Make it mobile-responsive
-
-    OUTPUT FORMAT:
-    - Return ONLY the component code
-    - No markdown code blocks (```)
-    - No explanations or comments outside the code
-    - No wrapper tags like <html> or <body>
-    - Self-contained component that works immediately
-
-    Remember: You are creating production-quality code that developers will use in real projects. Make it exceptional.
-    """
-    
-    initial_state = {
+    intent = _heuristic_intent(request_data.prompt, bool(request_data.base64Image))
+    history = [{"role": m.role, "content": m.content} for m in request_data.history] if request_data.history else ()
+    history_messages = _to_langchain_messages(request_data.history) if request_data.history else []
+    request_id = uuid.uuid4().hex
+    # Only the keys the graph reads up front; nodes fill in the rest as they run.
+    initial_state: GraphState = {
         "prompt": request_data.prompt,
-        "base64Image": request_data.base64Image,
+        "request_id": request_id,
+        "has_image": bool(request_data.base64Image),
         "framework": request_data.framework,
         "system_instruction": system_instruction,
-        "retry_count": 0,
-        "history": [{"role": m.role, "content": m.content} for m in (request_data.history or [])]
+        "retry_count": 0
     }
+    if request_data.base64Image:
+        initial_state["image_mime"] = request_data.image_mime
+    if history_messages:
+        initial_state["history_messages"] = history_messages
+
+    image_sha = await asyncio.to_thread(_image_digest, request_data.base64Image) if request_data.base64Image else ""
+    cache_key = _cache_key(framework, request_data.prompt, image_sha, history)
+    use_semantic_cache = _SEMANTIC_CACHE_ENABLED and not request_data.base64Image and not history
+    cached_code = _l1_get(cache_key) if intent != "chat" else None
+    if cached_code is None and intent != "chat" and use_semantic_cache:
+        cached_code = await _l2_get(framework, request_data.prompt)
 
     async def stream_generator():
+        if request_data.base64Image:
+            _REQ_BLOBS[request_id] = request_data.base64Image
         try:
+            if cached_code is not None:
+                logger.info("✓ Serving generated code from cache")
+                yield b"CODE:"
+                yield cached_code.encode()
+                return
+            if intent == "chat":
+                # Obvious chat needs no retry logic, so stream straight from the model without the graph.
+                logger.info("Generating chat response (direct)...")
+                yield b"CHAT:"
+                messages = [*history_messages, HumanMessage(content=request_data.prompt)]
+                async for batch in _coalesce_tokens(_LLM_CHAT.astream(messages)):
+                    yield batch
+                return
+            error_message = None
             async for chunk in app_graph.astream(initial_state):
                 if "chat" in chunk:
                     chat_output = chunk["chat"].get("chat_response")
                     if chat_output:
-                        yield "CHAT:"
-                        for token in chat_output:
-                            yield token.content
+                        yield b"CHAT:"
+                        async for batch in _coalesce_tokens(chat_output):
+                            yield batch
                         return
                 if "generate_code" in chunk:
                     generate_output = chunk["generate_code"]
+                    error_message = generate_output.get("error_message") if generate_output else None
                     if generate_output and "generated_code" in generate_output and generate_output["generated_code"]:
                         generation_stream = generate_output["generated_code"]
-                        yield "CODE:"
-                        for token in generation_stream:
-                            yield token.content
+                        yield b"CODE:"
+                        code_tokens: List[str] = []
+                        async for batch in _coalesce_tokens(generation_stream, sink=code_tokens):
+                            yield batch
+                        code = "".join(code_tokens)
+                        if code:
+                            _l1_put(cache_key, code)
+                            if use_semantic_cache:
+                                task = asyncio.create_task(_l2_put(framework, request_data.prompt, code))
+                                _L2_PENDING.add(task)
+                                task.add_done_callback(_L2_PENDING.discard)
+            if error_message:
+                yield f"ERROR: {error_message}".encode()
         except Exception as e:
             logger.error(f"Stream error: {e}")
-            yield f"ERROR: {str(e)}"
+            yield f"ERROR: {str(e)}".encode()
+        finally:
+            _REQ_BLOBS.pop(request_id, None)
     
-    return StreamingResponse(stream_generator(), media_type="text/plain")
+    if cached_code is not None:
+        return StreamingResponse(stream_generator(), media_type="text/plain")
+    flight = _INFLIGHT.get(cache_key)
+    if flight is None:
+        flight = _start_flight(cache_key, stream_generator())
+    else:
+        logger.info("Joining in-flight request for an identical prompt")
+    return StreamingResponse(_join_flight(cache_key, flight), media_type="text/plain")
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
     logger.info("Starting CodeCanvas AI API server...")
-    uvicorn.run("agent_service:api", host="0.0.0.0", port=8000, reload=True)
+    # Caches live in-process, so each worker keeps its own copy.
+    dev_mode = os.getenv("DEV") == "1"
+    workers = 1 if dev_mode else int(os.getenv("WORKERS", 1))
+    if workers > 1 and SETTINGS.rate_limit_storage_uri.startswith("memory://"):
+        logger.error("WORKERS > 1 requires a shared RATE_LIMIT_STORAGE_URI")
+        raise ValueError("WORKERS > 1 needs RATE_LIMIT_STORAGE_URI set to a shared store (e.g. redis://host:6379); the in-memory rate limiter is per process")
+    uvicorn.run(
+        "agent_service:api",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        reload=dev_mode,
+        workers=workers,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        log_level="info"
+    )
      